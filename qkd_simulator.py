@@ -1,11 +1,18 @@
-import base64
 import json
 import logging
+import re
 import uuid
-from hashlib import sha3_256
+from hashlib import sha256
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from sys import argv
 
+try:
+    from orjson import dumps as json_dumps
+except ImportError:
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(
     format="%(asctime)s %(levelname)s %(message)s",
@@ -13,11 +20,19 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S",
 )
 
+# /api/v1/keys/{slave_SAE_ID}/{enc_keys,dec_keys}?{query}
+KEYS_ROUTE = re.compile(r"/api/v1/keys/[^/?]+/(enc_keys|dec_keys)(?:\?(.*))?")
+
+# Only key and key_ID vary between responses, so skip the generic JSON encoder
+KEYS_RESPONSE = b'{"keys": [{"key": "%s", "key_ID": %s}]}'
+
 
 class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.server_version = "quPSKd/1.0"
+    server_version = "quPSKd/1.0"
+    # Allow clients to keep their connection open between key requests
+    protocol_version = "HTTP/1.1"
+    # Buffer headers and body, they are flushed with a single write per request
+    wbufsize = -1
 
     def log_message(self, format: str, *args) -> None:
         logger.debug(format % args)
@@ -25,42 +40,44 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
     def log_error(self, format: str, *args) -> None:
         logger.warning(format % args)
 
-    def handle_keys(self):
-        if "dec_keys" in self.path and "key_ID=" not in self.path:
+    def handle_keys(self, op, query):
+        if op == "dec_keys" and "key_ID=" not in query:
+            body = b"key_ID parameter is required"
             self.send_response(400)
+            self.send_header("Content-Length", str(len(body)))
             self.end_headers()
-            self.wfile.write(b"key_ID parameter is required")
+            self.wfile.write(body)
             return
 
-        if "dec_keys" in self.path:
-            key_ID = self.path.split("=")[-1]
+        if op == "dec_keys":
+            key_ID = query.split("=")[-1]
+            # The key_ID is client supplied and may need escaping
+            key_ID_json = json_dumps(key_ID)
         else:
             key_ID = str(uuid.uuid4())
-        key = base64.b64encode(sha3_256(key_ID.encode()).digest()).decode()
+            key_ID_json = b'"%s"' % key_ID.encode()
+        # Deviates from ETSI 014, which defines the key as base64: hex is only
+        # fine for consumers like qupskd that treat the key as an opaque string
+        key = sha256(key_ID.encode()).hexdigest().encode()
 
+        body = KEYS_RESPONSE % (key, key_ID_json)
         self.send_response(200)
         self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
         self.end_headers()
-        response = json.dumps(
-            {
-                "keys": [
-                    {
-                        "key": key,
-                        "key_ID": key_ID,
-                    }
-                ]
-            }
-        )
-        self.wfile.write(response.encode())
+        self.wfile.write(body)
 
     def handle_404(self):
+        body = b"404 Not Found"
         self.send_response(404)
+        self.send_header("Content-Length", str(len(body)))
         self.end_headers()
-        self.wfile.write(b"404 Not Found")
+        self.wfile.write(body)
 
     def do_GET(self):
-        if self.path.startswith("/api/v1/keys/"):
-            self.handle_keys()
+        match = KEYS_ROUTE.fullmatch(self.path)
+        if match:
+            self.handle_keys(*match.groups(""))
         else:
             self.handle_404()
 
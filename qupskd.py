@@ -1,21 +1,42 @@
 #!/usr/bin/env python3
 
 import asyncio
-import base64
 import json
 import logging
-import socket
 import threading
-import urllib.request
+import time
 import uuid
+from dataclasses import dataclass
+from functools import cache, partial
 from hashlib import sha3_256
-from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from http import HTTPStatus
+from http.client import HTTPConnection, HTTPSConnection
 from os import getenv
 from pathlib import Path
 from subprocess import run
+from urllib.parse import urlsplit
 
 import tomllib
 
+try:
+    from pybase64 import b64encode
+except ImportError:
+    from base64 import b64encode
+
+try:
+    from orjson import dumps as json_dumps
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+
+try:
+    from pyroute2 import WireGuard
+except ImportError:
+    WireGuard = None
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(
     format="%(asctime)s %(levelname)s %(message)s",
@@ -27,6 +48,8 @@ IDENTITY_STRING = "quPSKd Version 1"
 INITIATOR_WAIT_SECONDS = 120
 RESPONDER_WAIT_SECONDS = 130
 MAX_WAIT_SECONDS = 180
+MAX_BIND_DELAY_SECONDS = 30
+HTTP_TIMEOUT_SECONDS = 10
 
 config_file = getenv("QUPSKD_CONFIG_FILE", "/etc/qupskd.toml")
 
@@ -38,197 +61,310 @@ if "key_folder" in config:
     key_folder.mkdir(parents=True, exist_ok=True)
 
 
-def sha3_base64(input):
-    return base64.b64encode(sha3_256("".join(sorted(input)).encode()).digest())
+# Both peers must use the same hash, SHA3 stays the default for compatibility
+psk_hash_name = config.get("psk_hash", "sha3_256")
+if psk_hash_name == "blake3":
+    from blake3 import blake3 as psk_hash
+elif psk_hash_name == "sha3_256":
+    psk_hash = sha3_256
+else:
+    raise ValueError(f"Unsupported psk_hash: {psk_hash_name}")
 
 
-state = {
-    "key": None,
-    "key_ID": None,
-    "last_rotate": -2,
-    "initiator": False,
-    "psk": sha3_base64([config.get("psk", ""), IDENTITY_STRING]),
-}
+def hash_base64(input):
+    # Length-prefix every part so that e.g. ["ab", "c"] and ["a", "bc"] differ
+    parts = sorted(x.encode() if isinstance(x, str) else x for x in input)
+    h = psk_hash()
+    for part in parts:
+        h.update(len(part).to_bytes(4, "little"))
+        h.update(part)
+    return b64encode(h.digest())
+
+
+# The initial PSK only depends on the configuration, so derive it once
+INITIAL_PSK = hash_base64([config.get("psk", ""), IDENTITY_STRING])
+
+
+@dataclass(slots=True)
+class State:
+    psk: bytes
+    # Monotonic time of the last PSK update
+    last_rotate: float
+    key: str | None = None
+    key_ID: str | None = None
+    initiator: bool = False
+
+
+# Start with a rotation being due
+state = State(psk=INITIAL_PSK, last_rotate=time.monotonic() - RESPONDER_WAIT_SECONDS)
+
+
+# fetch_json runs in worker threads, so keep one connection per host and thread
+connections = threading.local()
+
+
+def get_connection(url):
+    pool = vars(connections)
+    if url.netloc not in pool:
+        if url.scheme == "https":
+            pool[url.netloc] = HTTPSConnection(url.netloc, timeout=HTTP_TIMEOUT_SECONDS)
+        else:
+            pool[url.netloc] = HTTPConnection(url.netloc, timeout=HTTP_TIMEOUT_SECONDS)
+    return pool[url.netloc]
+
+
+def request(conn, target):
+    try:
+        conn.request("GET", target)
+        response = conn.getresponse()
+        return response.status, response.read()
+    except Exception:
+        # Never leave a half-used connection behind for the next request
+        conn.close()
+        raise
 
 
 def fetch_json(url):
     logger.info(f"Fetching data from {url}")
 
-    with urllib.request.urlopen(url) as response:
-        if response.status == 200:
-            return json.loads(response.read().decode())
-        else:
-            logger.error(f"Failed to fetch data, status code: {response.status}")
-            return None
+    url = urlsplit(url)
+    target = f"{url.path}?{url.query}" if url.query else url.path
+    conn = get_connection(url)
+
+    # A kept-alive connection may have been closed by the server meanwhile,
+    # retry once on a fresh connection in that case
+    reused = conn.sock is not None
+    try:
+        status, body = request(conn, target)
+    except ConnectionError:
+        if not reused:
+            raise
+        status, body = request(conn, target)
+
+    if status == 200:
+        return json_loads(body)
+    else:
+        logger.error(f"Failed to fetch data, status code: {status}")
+        return None
 
 
+# These run in worker threads, so they return the key instead of touching state
 def fetch_qkd(url):
     data = fetch_json(url)
-    state["key_ID"] = data["keys"][0]["key_ID"]
-    state["key"] = data["keys"][0]["key"]
+    return data["keys"][0]["key_ID"], data["keys"][0]["key"]
 
 
-def fetch_qkd_key_id():
-    fetch_qkd(
-        f"{config['etsi_url']}/api/v1/keys/{config['remote_SAE_ID']}/dec_keys?key_ID={state['key_ID']}"
+def fetch_qkd_key_id(key_ID):
+    return fetch_qkd(
+        f"{config['etsi_url']}/api/v1/keys/{config['remote_SAE_ID']}/dec_keys?key_ID={key_ID}"
     )
 
 
 def fetch_qkd_key():
-    fetch_qkd(
+    return fetch_qkd(
         f"{config['etsi_url']}/api/v1/keys/{config['remote_SAE_ID']}/enc_keys?number=1"
     )
 
 
-def psk_update():
-    parts = [
-        state["key"],
-        state["key_ID"],
-        state["psk"].decode(),
-    ]
+# Opened on first use, so a missing wireguard kernel module is only an error
+# once a PSK is applied, not at startup
+@cache
+def get_wireguard():
+    return WireGuard()
 
-    state["psk"] = sha3_base64(parts)
-    if "wireguard_public_key" in config:
+
+def set_psk(psk):
+    # Set the PSK via Netlink if possible, otherwise fall back to wg-set-psk
+    if "wireguard_public_key" in config and WireGuard:
+        get_wireguard().set(
+            f"wg0_{config['alias']}",
+            peer={
+                "public_key": config["wireguard_public_key"],
+                "preshared_key": psk.decode(),
+            },
+        )
+    elif "wireguard_public_key" in config:
         run(
             args=[
                 "wg-set-psk",
                 f"wg0_{config['alias']}",
                 config["wireguard_public_key"],
             ],
-            input=state["psk"],
+            input=psk,
+            check=True,
         )
     else:
-        (key_folder / f"{config['alias']}.key").write_bytes(state["psk"])
+        (key_folder / f"{config['alias']}.key").write_bytes(psk)
+
+
+async def psk_update(parts):
+    psk = hash_base64(parts)
+    # Writing the PSK blocks, keep the event loop free to serve the peer
+    try:
+        await asyncio.to_thread(set_psk, psk)
+    except Exception as e:
+        # The peer derives the same PSK regardless, so advance the chain to
+        # stay in sync and apply the next PSK on the following rotation
+        logger.error(f"Failed to apply PSK: {e}")
+
+    state.psk = psk
+    state.last_rotate = time.monotonic()
 
     logger.info(f"new PSK: {config['source_KME_ID']} <-> {config['target_KME_ID']}")
 
-    state["last_rotate"] = 0
 
+async def handle_rotate(new=False):
+    if new:
+        state.psk = INITIAL_PSK
+        logger.info("Initiating key rotation")
 
-class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.server_version = "quPSKd/1.0"
+    state.key_ID, state.key = await asyncio.to_thread(fetch_qkd_key)
 
-    def log_message(self, format: str, *args) -> None:
-        logger.debug(format % args)
+    response = json_dumps(
+        {
+            "status": "ok",
+            "key_ID": state.key_ID,
+        }
+    )
+    state.initiator = False
+    return 200, response
 
-    def log_error(self, format: str, *args) -> None:
-        logger.warning(format % args)
 
-    def handle_rotate(self, new=False):
-        if new:
-            state["psk"] = sha3_base64([config.get("psk", ""), IDENTITY_STRING])
-            logger.info("Initiating key rotation")
+async def handle_ack():
+    await psk_update([state.key, state.key_ID, state.psk])
 
-        fetch_qkd_key()
+    response = json_dumps(
+        {
+            "status": "ok",
+        }
+    )
+    return 200, response
 
-        self.send_response(200)
-        self.send_header("Content-type", "application/json")
-        self.end_headers()
-        response = json.dumps(
-            {
-                "status": "ok",
-                "key_ID": state["key_ID"],
-            }
-        )
-        self.wfile.write(response.encode())
-        state["initiator"] = False
-
-    def handle_ack(self):
-        psk_update()
-
-        self.send_response(200)
-        self.send_header("Content-type", "application/json")
-        self.end_headers()
-        response = json.dumps(
-            {
-                "status": "ok",
-            }
-        )
-        self.wfile.write(response.encode())
-
-    def handle_404(self):
-        self.send_response(404)
-        self.end_headers()
-        self.wfile.write(b"404 Not Found")
-
-    def do_GET(self):
-        if self.path == "/new":
-            self.handle_rotate(new=True)
-        elif self.path == "/rotate":
-            self.handle_rotate()
-        elif self.path == "/ack":
-            self.handle_ack()
+
+async def handle_404():
+    return 404, b"404 Not Found"
+
+
+ROUTES = {
+    "/new": partial(handle_rotate, new=True),
+    "/rotate": handle_rotate,
+    "/ack": handle_ack,
+}
+
+
+async def handle_request(reader, writer):
+    request_line = ""
+    try:
+        request_line = (await reader.readline()).decode("latin-1").rstrip()
+        # Headers are not used, skip them until the empty line
+        while (await reader.readline()).strip():
+            pass
+
+        try:
+            method, path, _ = request_line.split(" ", 2)
+        except ValueError:
+            status, body = 400, b"400 Bad Request"
         else:
-            self.handle_404()
+            if method != "GET":
+                status, body = 501, b"501 Not Implemented"
+            else:
+                status, body = await ROUTES.get(path, handle_404)()
+    except Exception as e:
+        logger.warning(e)
+        status, body = 500, b"500 Internal Server Error"
 
+    logger.debug(f'"{request_line}" {status} -')
 
-def run_server():
-    httpd = ThreadingHTTPServer(
-        (config["qupskd_bind"], config["qupskd_port"]), SimpleHTTPRequestHandler
+    content_type = b"Content-type: application/json\r\n" if status == 200 else b""
+    writer.write(
+        b"HTTP/1.0 %d %s\r\nServer: quPSKd/1.0\r\n%sContent-Length: %d\r\n\r\n%s"
+        % (status, HTTPStatus(status).phrase.encode(), content_type, len(body), body)
     )
+    try:
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def run_server():
+    # start_server sets SO_REUSEADDR, so only a port that is really in use
+    # (e.g. during boot) needs another attempt
+    delay = 1
+    while True:
+        try:
+            server = await asyncio.start_server(
+                handle_request, config["qupskd_bind"], config["qupskd_port"]
+            )
+            break
+        except OSError:
+            logger.warning(
+                f"Waiting for {config['qupskd_bind']}:{config['qupskd_port']} to become available"
+            )
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_BIND_DELAY_SECONDS)
+
     logger.info(f"Serving at http://{config['qupskd_bind']}:{config['qupskd_port']}")
-    httpd.serve_forever()
+    return server
+
+
+async def rotate():
+    if not state.key_ID:
+        url = f"{config['remote_qupskd_url']}/new"
+    else:
+        url = f"{config['remote_qupskd_url']}/rotate"
+
+    # fetch_json blocks, keep the event loop free to serve the peer
+    data = await asyncio.to_thread(fetch_json, url)
+    key_ID, key = await asyncio.to_thread(fetch_qkd_key_id, data.get("key_ID"))
+    state.key_ID, state.key = key_ID, key
+
+    # Only acknowledge once the local key is known, otherwise a failing QKD
+    # request would leave the peer with a PSK this side never derives
+    await asyncio.to_thread(fetch_json, f"{config['remote_qupskd_url']}/ack")
+
+    await psk_update([state.key, state.key_ID, state.psk])
 
 
 async def fetch_peer_data():
     while True:
-        state["last_rotate"] += 1
         try:
-            if state["last_rotate"] > MAX_WAIT_SECONDS:
+            since_rotate = time.monotonic() - state.last_rotate
+            if since_rotate > MAX_WAIT_SECONDS:
                 logger.warning("Key rotation failed. Setting random PSK")
-                state["psk"] = sha3_base64([uuid.uuid4().hex])
-                psk_update()
+                random_psk = hash_base64([uuid.uuid4().hex])
+                # Before the first rotation no QKD key is known to mix in
+                parts = [state.key, state.key_ID, random_psk]
+                await psk_update([part for part in parts if part is not None])
                 continue
 
-            if state["initiator"]:
-                if -1 < state["last_rotate"] < INITIATOR_WAIT_SECONDS:
-                    await asyncio.sleep(1)
-                    continue
-            else:
-                if -1 < state["last_rotate"] < RESPONDER_WAIT_SECONDS:
-                    await asyncio.sleep(1)
-                    continue
-                else:
-                    state["initiator"] = True
-
-            if not state["key_ID"]:
-                url = f"{config['remote_qupskd_url']}/new"
+            if state.initiator:
+                wait_seconds = INITIATOR_WAIT_SECONDS
             else:
-                url = f"{config['remote_qupskd_url']}/rotate"
+                wait_seconds = RESPONDER_WAIT_SECONDS
 
-            data = fetch_json(url)
-            state["key_ID"] = data.get("key_ID")
-
-            fetch_qkd_key_id()
-
-            fetch_json(f"{config['remote_qupskd_url']}/ack")
+            if since_rotate < wait_seconds:
+                # A rotation initiated by the peer moves the deadline, so check
+                # again after waking up instead of rotating right away
+                await asyncio.sleep(wait_seconds - since_rotate)
+                continue
 
-            psk_update()
+            state.initiator = True
+            try:
+                async with asyncio.timeout(MAX_WAIT_SECONDS - since_rotate) as cm:
+                    await rotate()
+            except TimeoutError:
+                # Socket timeouts of single requests are retried after a pause
+                if not cm.expired():
+                    raise
+                logger.error("Key rotation timed out")
         except Exception as e:
             logger.error(e)
             await asyncio.sleep(1)
 
 
 async def main():
-    while True:
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.bind((config["qupskd_bind"], config["qupskd_port"]))
-                s.close()
-                break
-        except OSError:
-            logger.warning(
-                f"Waiting for {config['qupskd_bind']}:{config['qupskd_port']} to become available"
-            )
-            await asyncio.sleep(1)
-
-    # Run the server in a separate thread because it's not async
-    server_thread = threading.Thread(target=run_server, daemon=True)
-    server_thread.start()
-
-    await fetch_peer_data()
+    async with await run_server():
+        await fetch_peer_data()
 
 
 if __name__ == "__main__":